@@ -3,21 +3,292 @@
 #!/usr/bin/env python
 
 import os
-import subprocess
 import math
-import shutil
+import mmap
 import json
-import csv
+import gzip
+import re
+import struct
+from concurrent.futures import ThreadPoolExecutor
 
 import dxpy
 
 
-def run_samtools_idxstat(bamfile, bamfile_prefix):
+BAM_MAGIC = b"BAM\1"
+BAI_MAGIC = b"BAI\1"
+# pseudo-bin in which the index stores the read counts of a reference
+BAI_PSEUDO_BIN = 37450
+# size of the requests streaming a BAM header, BGZF blocks are up to 64KiB
+BAM_HEADER_BUFFER_SIZE = 64 * 1024
+# samples processed at once, ThreadPoolExecutor's default for I/O bound work
+MAX_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+# row of samtools idxstat output: name, length, mapped and unmapped reads
+IDXSTAT_ROW = re.compile(rb"^([^\t\n]+)\t(\d+)\t(\d+)\t(\d+)\r?$", re.M)
+
+# names of chromosomes 1 and Y, e.g. GRCh37 and GRCh38/UCSC style
+CHR_1_NAMES = frozenset(("1", "chr1"))
+CHR_Y_NAMES = frozenset(("Y", "chrY"))
+
+# sexes that may be given in the second to last field of a sample name
+REPORTED_SEXES = frozenset(("M", "F", "U"))
+
+# result of comparing (reported, predicted) sex, any other pair is "NA"
+SEX_MATCH = {
+    ("M", "M"): "True",
+    ("F", "F"): "True",
+    ("M", "F"): "False",
+    ("F", "M"): "False",
+    ("M", "U"): "False",
+    ("F", "U"): "False",
+}
+
+# MultiQC table config, the data of the samples is added per run
+MULTIQC_CONFIG_TEMPLATE = {
+    "id": "sex_check",
+    "section_name": "Sex Check",
+    "description": "Table comparing reported and predicted sex",
+    "plot_type": "table",
+    "pconfig": {
+        "id": "sex_check_table",
+        "title": "Sex Check Table",
+        "format": "{:.0f}"
+    },
+    "headers": {
+        "matched": {
+            "title": "Matched",
+            "description": "Whether reported sex is same as predicted sex",
+            "cond_formatting_rules": {
+                "pass": [{"s_eq": "True"}],
+                "warn": [{"s_eq": "NA"}],
+                "fail": [{"s_eq": "False"}]
+            }
+        },
+        "reported_sex": {
+            "title": "Reported Sex",
+            "description": "Expected sex reported in sample name",
+            "cond_formatting_rules": {
+                "warn": [{"s_eq": "N"}, {"s_eq": "U"}]
+            }
+        },
+        "predicted_sex": {
+            "title": "Predicted Sex",
+            "description": "Sex inferred from normalised score",
+            "cond_formatting_rules": {
+                "warn": [{"s_eq": "U"}]
+            }
+        },
+        "score": {
+            "title": "Score",
+            "description": "Negative log of mapped_chrY/mapped_chr1",
+            "format": "{:.4f}"
+        },
+        "mapped_chrY": {
+            "title": "Mapped Reads ChrY",
+            "description": "Number of reads mapped to chromosome Y"
+        },
+        "mapped_chr1": {
+            "title": "Mapped Reads Chr1",
+            "description": "Number of reads mapped to chromosome 1"
+        }
+    }
+}
+
+
+def read_bam_references(bamfile):
     """
-    Run samtools idxstat on a BAM file and write the output to a TSV file.
+    Reads the reference sequence dictionary from the header of a BAM file.
+    Only the header is decompressed, alignment records are never read.
+
+    Expected file is structured as described in the SAM/BAM spec (4.2):
+    https://samtools.github.io/hts-specs/SAMv1.pdf
 
     Args:
-        bamfile (str): local name of the BAM file.
+        bamfile (str or file object): local name of the BAM file, or the
+        BAM file opened in binary mode.
+
+    Returns:
+        list: (reference name, reference length) tuples in header order,
+              which is also the order of references in the BAI index.
+
+    Raises:
+        ValueError: If the file is not a BAM file.
+    """
+    with gzip.open(bamfile, "rb") as bam:
+        if bam.read(4) != BAM_MAGIC:
+            raise ValueError(f"{bamfile} is not a BAM file.")
+
+        l_text, = struct.unpack("<i", bam.read(4))
+        bam.read(l_text)
+
+        n_ref, = struct.unpack("<i", bam.read(4))
+        references = []
+        for _ in range(n_ref):
+            l_name, = struct.unpack("<i", bam.read(4))
+            name = bam.read(l_name).rstrip(b"\0").decode()
+            l_ref, = struct.unpack("<i", bam.read(4))
+            references.append((name, l_ref))
+
+    return references
+
+
+def parse_index_stats(data, index_file, last_reference=None):
+    """
+    Parses the per-reference read counts stored in a BAI index.
+
+    Every reference with reads has a pseudo-bin (37450) in the index whose
+    second chunk holds the number of mapped and unmapped reads, which is
+    what samtools idxstats reports. See the SAM/BAM spec (5.2):
+    https://samtools.github.io/hts-specs/SAMv1.pdf
+
+    Args:
+        data (bytes-like): The BAI index, e.g. bytes or a memory map.
+        index_file (str or file object): The BAI index the data is from,
+        only used in error messages.
+        last_reference (int): Position of the last reference to read the
+        counts of, the rest of the index is not parsed. All references are
+        read if None.
+
+    Returns:
+        tuple: (number of references in the index,
+                list of (mapped, unmapped) tuples in reference order,
+                number of unplaced unmapped reads, None if not read)
+
+    Raises:
+        ValueError: If the data is not a BAI index, has no read counts or
+        is truncated.
+    """
+    if data[:4] != BAI_MAGIC:
+        raise ValueError(f"{index_file} is not a BAI index.")
+
+    # a truncated index runs out of data part way through a reference
+    try:
+        n_ref, = struct.unpack_from("<i", data, 4)
+        if last_reference is None:
+            last_reference = n_ref - 1
+
+        offset = 8
+        counts = []
+        for ref in range(min(n_ref, last_reference + 1)):
+            n_bin, = struct.unpack_from("<i", data, offset)
+            offset += 4
+            ref_counts = (0, 0) if n_bin == 0 else None
+            for _ in range(n_bin):
+                bin_id, n_chunk = struct.unpack_from("<Ii", data, offset)
+                offset += 8
+                if bin_id == BAI_PSEUDO_BIN:
+                    ref_counts = struct.unpack_from("<QQ", data, offset + 16)
+                offset += n_chunk * 16
+
+            if ref_counts is None:
+                raise ValueError(
+                    f"{index_file} has no read counts for reference {ref}. "
+                    "Re-index the BAM file with samtools index."
+                )
+            counts.append(ref_counts)
+
+            n_intv, = struct.unpack_from("<i", data, offset)
+            offset += 4 + n_intv * 8
+
+        if len(counts) < n_ref:
+            return n_ref, counts, None
+
+        # the number of unplaced unmapped reads at the end is optional
+        n_no_coor = 0
+        if len(data) >= offset + 8:
+            n_no_coor, = struct.unpack_from("<Q", data, offset)
+    except struct.error as error:
+        raise ValueError(f"{index_file} is truncated or corrupt.") from error
+
+    return n_ref, counts, n_no_coor
+
+
+def read_index_stats(index_file, last_reference=None):
+    """
+    Reads the per-reference read counts stored in a BAI index, as parsed
+    by parse_index_stats.
+
+    Args:
+        index_file (str or file object): local name of the BAI index file,
+        or the index file opened in binary mode.
+        last_reference (int): Position of the last reference to read the
+        counts of, the rest of the index is not parsed. All references are
+        read if None.
+
+    Returns:
+        tuple: (number of references in the index,
+                list of (mapped, unmapped) tuples in reference order,
+                number of unplaced unmapped reads, None if not read)
+
+    Raises:
+        ValueError: If the file is not a BAI index, has no read counts or
+        is truncated.
+    """
+    if hasattr(index_file, "read"):
+        return parse_index_stats(index_file.read(), index_file, last_reference)
+
+    # the index is mapped rather than read, only the parts of it that are
+    # parsed are paged in
+    with open(index_file, "rb") as file, \
+            mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return parse_index_stats(data, index_file, last_reference)
+
+
+def get_idxstats(bamfile, index_file, complete=True):
+    """
+    Gets the per-reference read counts of a BAM file from its index, in
+    the same layout as samtools idxstats, without running samtools.
+    If not complete, only rows up to the last of chromosomes 1 and Y are
+    returned and the rest of the index is not parsed, which is all that
+    get_mapped_reads needs.
+
+    Args:
+        bamfile (str or file object): local name of the BAM file, or the
+        BAM file opened in binary mode. Only its header is read.
+        index_file (str or file object): local name of the BAI index file,
+        or the index file opened in binary mode.
+        complete (bool): Whether to get the rows of all references.
+
+    Returns:
+        list: (RefSeqName, SeqLength, #mappedReads, #UnmappedReads) tuples,
+              ending with the "*" row of unplaced unmapped reads if complete.
+
+    Raises:
+        ValueError: If the index is not a valid BAI index, or if the BAM
+        header and index disagree on references.
+    """
+    references = read_bam_references(bamfile)
+
+    last_reference = None
+    if not complete:
+        last_reference = max((
+            position for position, (name, _) in enumerate(references)
+            if name in CHR_1_NAMES or name in CHR_Y_NAMES
+        ), default=-1)
+
+    n_ref, counts, n_no_coor = read_index_stats(index_file, last_reference)
+
+    if len(references) != n_ref:
+        raise ValueError(
+            f"{bamfile} has {len(references)} references but {index_file} "
+            f"has {n_ref}. Is this the right index?"
+        )
+
+    idxstats = [
+        (name, length, mapped, unmapped)
+        for (name, length), (mapped, unmapped) in zip(references, counts)
+    ]
+    if n_no_coor is not None:
+        idxstats.append(("*", 0, 0, n_no_coor))
+
+    return idxstats
+
+
+def write_idxstat(idxstats, bamfile_prefix):
+    """
+    Write idxstats to a TSV file in the same format as samtools idxstat.
+
+    Args:
+        idxstats (list): per-reference read counts from get_idxstats.
         bamfile_prefix (str): Prefix for the output file name.
 
     Returns:
@@ -26,56 +297,175 @@ def run_samtools_idxstat(bamfile, bamfile_prefix):
     # Define the output file name
     output_file = bamfile_prefix + '_idxstat.tsv'
 
-    # Run samtools idxstat and capture any errors
     with open(output_file, 'w', encoding="utf-8") as outfile:
-        subprocess.run(
-            ['samtools', 'idxstat', bamfile],
-            stdout=outfile, check=True
-            )
-    print("samtools finished running successfully")
+        outfile.writelines(
+            "\t".join(map(str, row)) + "\n" for row in idxstats
+        )
 
     return output_file
 
 
-def get_mapped_reads(filename):
+def parse_idxstat(data):
+    """
+    Parses samtools idxstat output row by row, each row being matched by a
+    regex only when it is asked for, so a caller that stops early (e.g.
+    get_mapped_reads) does not scan the rest of the data.
+
+    Args:
+        data (bytes-like): The idxstat output, e.g. bytes or a memory map.
+
+    Yields:
+        tuple: (RefSeqName, SeqLength, #mappedReads, #UnmappedReads),
+               as returned by get_idxstats.
+    """
+    for row in IDXSTAT_ROW.finditer(data):
+        name, length, mapped, unmapped = row.groups()
+        yield name.decode(), int(length), int(mapped), int(unmapped)
+
+
+def read_idxstat(source):
+    """
+    Reads a TSV file of samtools idxstat output row by row. A file given
+    by path is memory-mapped rather than read.
+
+    Args:
+        source (str or file object): The path to the idxstat output file,
+        or the file opened in binary mode.
+
+    Yields:
+        tuple: (RefSeqName, SeqLength, #mappedReads, #UnmappedReads),
+               as returned by get_idxstats.
+    """
+    if hasattr(source, "read"):
+        yield from parse_idxstat(source.read())
+        return
+
+    with open(source, 'rb') as file:
+        # empty files cannot be memory-mapped
+        if not os.fstat(file.fileno()).st_size:
+            return
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from parse_idxstat(data)
+
+
+def load_idxstats(bamfile, index_file, bamfile_prefix, write_output=True):
+    """
+    Gets idxstats of a BAM file and, if requested, writes them to
+    <prefix>_idxstat.tsv. If that file already exists and is newer than
+    the index, e.g. when rerunning on the same BAM, it is read back lazily
+    instead.
+
+    Args:
+        bamfile (str or file object): local name of the BAM file, or the
+        BAM file opened in binary mode. Only its header is read.
+        index_file (str): local name of the BAI index file.
+        bamfile_prefix (str): Prefix for the output file name.
+        write_output (bool): Whether to write the idxstats to a file.
+
+    Returns:
+        tuple: (idxstats as a list or iterator,
+                name of the file containing the idxstat results, or None
+                if it was not written)
+    """
+    output_file = bamfile_prefix + '_idxstat.tsv'
+
+    if (os.path.exists(output_file) and
+            os.stat(output_file).st_mtime > os.stat(index_file).st_mtime):
+        print(f"{output_file} is newer than {index_file}, reusing it")
+        return read_idxstat(output_file), output_file
+
+    # the rows after chromosomes 1 and Y are only needed for the file
+    idxstats = get_idxstats(bamfile, index_file, complete=write_output)
+
+    if not write_output:
+        return idxstats, None
+
+    return idxstats, write_idxstat(idxstats, bamfile_prefix)
+
+
+def find_cached_idxstat(properties):
+    """
+    Finds an idxstat TSV file previously uploaded by this app to the
+    current project for the same BAM and index files.
+
+    Args:
+        properties (dict): file IDs of the input BAM and index files, as
+        set on the uploaded idxstat file.
+
+    Returns:
+        dict: project and ID of the cached file, or None if not found.
+    """
+    return dxpy.find_one_data_object(
+        classname="file",
+        name="*_idxstat.tsv",
+        name_mode="glob",
+        state="closed",
+        properties=properties,
+        project=dxpy.PROJECT_CONTEXT_ID,
+        zero_ok=True,
+        more_ok=True
+    )
+
+
+def get_mapped_reads(idxstats):
     """
-    Reads a file containing idxstat output and extracts the mapped reads for
-    chromosomes 1 and Y. Then calculates a normalised score (-log(chrY/chr1))
+    Extracts the mapped reads for chromosomes 1 and Y from idxstats.
+    Then calculates the proportion of chrY to chr1 reads (chrY/chr1)
 
-    Expected file is structured as described in samtools doc:
+    Expected rows are structured as described in samtools doc:
     http://www.htslib.org/doc/samtools-idxstats.html
-    i.e. a tsv file with each line consisting of :
+    i.e. each row consisting of :
     RefSeqName, SeqLength, #mappedReads, and #UnmappedReads;
-    N/B line starts without prefix "chr"
+    N/B reference names may be with or without prefix "chr"
 
     Args:
-        filename (str): The path to the idxstat output file.
+        idxstats (iterable): per-reference read counts, e.g. from
+        get_idxstats. Consumption stops once chromosomes 1 and Y are seen.
 
     Returns:
         tuple: (number of mapped reads for chromosome 1,
                 number of mapped reads for chromosome Y,
-                normalised score)
+                ratio of chrY to chr1 reads, 0 if there are no chr1 reads)
     """
     chr_1 = chr_y = 0
-    epsilon = 1e-9  # small value to avoid log(0)
-
-    with open(filename, encoding="utf-8") as file:
-        reader = csv.reader(file, delimiter="\t")
-        for line in reader:
-            if line[0] == "1":
-                chr_1 = int(line[2])
-            elif line[0] == "Y":
-                chr_y = int(line[2])
+    found_chr_1 = found_chr_y = False
+
+    for row in idxstats:
+        if row[0] in CHR_1_NAMES:
+            chr_1 = int(row[2])
+            found_chr_1 = True
+        elif row[0] in CHR_Y_NAMES:
+            chr_y = int(row[2])
+            found_chr_y = True
+        # the remaining rows are not needed once both have been seen
+        if found_chr_1 and found_chr_y:
+            break
 
     if not chr_1:
         print("No mapped reads for chromosome 1. Using 0 instead.")
     if not chr_y:
         print("No mapped reads for chromosome Y. Using 0 instead.")
 
-    norm_chr_y = chr_y / chr_1 if chr_1 != 0 else 0
-    score = -math.log(norm_chr_y + epsilon)
+    ratio = chr_y / chr_1 if chr_1 != 0 else 0
+
+    return chr_1, chr_y, ratio
+
+
+def get_score(ratio):
+    """
+    Calculates the normalised score (-log(chrY/chr1)) reported for a sample.
+    N/B: Higher score = fewer proportion of reads mapped to chr Y
+
+    Args:
+        ratio (float): The ratio of chrY to chr1 reads.
+
+    Returns:
+        float: The normalised score.
+    """
+    epsilon = 1e-9  # small value to avoid log(0)
 
-    return chr_1, chr_y, score
+    return -math.log(ratio + epsilon)
 
 
 def get_reported_sex(sample_name):
@@ -92,49 +482,117 @@ def get_reported_sex(sample_name):
         str: The reported sex extracted from the sample name or 'N' if 
         undetermined or invalid.
     """
-    parts = sample_name.split('-')
+    # only the last two fields are needed, so leave the rest of the name
+    parts = sample_name.rsplit('-', 2)
     if len(parts) < 3:
         print(f"{sample_name} is too short to determine sex. Returning N")
         return "N"
 
     sex = parts[-2].upper()
-    if sex not in ["M", "F", "U"]:
+    if sex not in REPORTED_SEXES:
         print(f"Extracted {sex} from {sample_name} is invalid. Returning N")
         return "N"
 
     return sex
 
 
-def get_predicted_sex(score, male_threshold, female_threshold):
+def validate_thresholds(male_threshold, female_threshold):
     """
-    Determines the predicted sex based on score and defined thresholds.
-    N/B: Higher score = fewer proportion of reads mapped to chr Y
+    Checks that the thresholds are logically set.
 
     Args:
-        score (float): The normalised reads count for chromosome Y.
         male_threshold (float): The threshold below which the sample is
         considered male.
         female_threshold (float): The threshold above which the sample is
         considered female.
 
-    Returns:
-        str: The predicted sex ('M' for male, 'F' for female, 'U' for unknown).
-
     Raises:
-        ValueError: If the thresholds are not logically set
-        (ie male_threshold should be lower than female_threshold).
+        ValueError: If male_threshold is not lower than female_threshold.
     """
-    # Validate thresholds
     if male_threshold >= female_threshold:
         raise ValueError("Male threshold must be less than female threshold.")
 
-    # Determine sex based on thresholds
-    if score <= male_threshold:
-        return "M"
-    elif score >= female_threshold:
-        return "F"
-    else:
-        return "U"
+
+def get_ratio_thresholds(male_threshold, female_threshold):
+    """
+    Converts score thresholds to thresholds on the ratio of chrY to chr1
+    reads, so samples can be compared without computing their score.
+    N/B: score = -log(ratio), so the male ratio threshold is the higher one
+
+    Args:
+        male_threshold (float): The score below which the sample is
+        considered male.
+        female_threshold (float): The score above which the sample is
+        considered female.
+
+    Returns:
+        tuple: (ratio above which the sample is considered male,
+                ratio below which the sample is considered female)
+
+    Raises:
+        ValueError: If male_threshold is not lower than female_threshold.
+    """
+    validate_thresholds(male_threshold, female_threshold)
+
+    return math.exp(-male_threshold), math.exp(-female_threshold)
+
+
+def make_sex_predictor(male_threshold, female_threshold):
+    """
+    Makes a function predicting sex from the ratio of chrY to chr1 reads,
+    with the score thresholds validated and converted to ratio thresholds
+    once rather than for every sample.
+    N/B: Higher ratio = higher proportion of reads mapped to chr Y
+
+    Args:
+        male_threshold (float): The score below which the sample is
+        considered male.
+        female_threshold (float): The score above which the sample is
+        considered female.
+
+    Returns:
+        function: Takes the ratio of a sample and returns its predicted sex
+                  ('M' for male, 'F' for female, 'U' for unknown).
+
+    Raises:
+        ValueError: If male_threshold is not lower than female_threshold.
+    """
+    male_ratio, female_ratio = get_ratio_thresholds(
+        male_threshold, female_threshold
+    )
+
+    def predict_sex(ratio):
+        # Determine sex based on thresholds
+        if ratio >= male_ratio:
+            return "M"
+        elif ratio <= female_ratio:
+            return "F"
+        else:
+            return "U"
+
+    return predict_sex
+
+
+def get_predicted_sex(ratio, male_threshold, female_threshold):
+    """
+    Determines the predicted sex based on ratio and defined thresholds.
+    For many samples, make a predictor once with make_sex_predictor.
+    N/B: Higher ratio = higher proportion of reads mapped to chr Y
+
+    Args:
+        ratio (float): The ratio of chrY to chr1 reads.
+        male_threshold (float): The score below which the sample is
+        considered male.
+        female_threshold (float): The score above which the sample is
+        considered female.
+
+    Returns:
+        str: The predicted sex ('M' for male, 'F' for female, 'U' for unknown).
+
+    Raises:
+        ValueError: If male_threshold is not lower than female_threshold.
+    """
+    return make_sex_predictor(male_threshold, female_threshold)(ratio)
 
 
 def check_sex_match(reported_sex, predicted_sex):
@@ -150,116 +608,275 @@ def check_sex_match(reported_sex, predicted_sex):
         str: "True" if predicted sex matches reported sex, "False" otherwise.
              "NA" if reported sex is "N" or "U".
     """
+    return SEX_MATCH.get((reported_sex, predicted_sex), "NA")
 
-    if reported_sex in ["N", "U"]:
-        return "NA"
 
-    return str(reported_sex == predicted_sex)
+def get_sex_check_result(sample_name, chr_1, chr_y, ratio, predict_sex):
+    """
+    Performs sex determination of one sample from its mapped reads.
 
+    Args:
+        sample_name (str): The name of the sample, containing the reported
+        sex.
+        chr_1 (int): The number of reads mapped to chromosome 1.
+        chr_y (int): The number of reads mapped to chromosome Y.
+        ratio (float): The ratio of chrY to chr1 reads.
+        predict_sex (function): Predicts sex from the ratio, as made by
+        make_sex_predictor.
 
-@dxpy.entry_point('main')
-def main(input_bam, index_file, male_threshold, female_threshold):
+    Returns:
+        dict: sex check results of the sample for the MultiQC table.
     """
-    Main function for the DNAnexus app to perform sex determination
-    based on BAM file data.
+    predicted_sex = predict_sex(ratio)
+    reported_sex = get_reported_sex(sample_name)
+
+    return {
+        "matched": check_sex_match(reported_sex, predicted_sex),
+        "reported_sex": reported_sex,
+        "predicted_sex": predicted_sex,
+        "score": get_score(ratio),
+        "mapped_chrY": chr_y,
+        "mapped_chr1": chr_1
+    }
+
+
+def get_bam_prefix(bam_file_name):
+    """
+    Gets the prefix used to name the outputs of a BAM file, i.e. its name
+    without the .bam extension and _markdup suffix.
 
     Args:
-        input_bam (str): The ID of the input BAM file in DNAnexus.
-        index_file (str): The ID of the index file associated with the BAM file.
-        male_threshold (float): Value below which sample is considered male.
-        female_threshold (float): Value above which sample is considered female.
+        bam_file_name (str): The name of the BAM file.
+
     Returns:
-        dict: Dictionary of output file links in DNAnexus.
+        str: The prefix of the BAM file.
     """
+    prefix = os.path.splitext(bam_file_name)[0]
+    # not rstrip, which strips any trailing characters in "_markdup"
+    if prefix.endswith('_markdup'):
+        prefix = prefix[:-len('_markdup')]
 
-    inputs = dxpy.download_all_inputs()
+    return prefix
 
-    shutil.move(inputs['input_bam_path'][0], os.getcwd())
-    shutil.move(inputs['index_file_path'][0], os.getcwd())
 
-    bam_file_name = inputs['input_bam_name'][0]
-    bam_file_prefix = inputs['input_bam_prefix'][0].rstrip('_markdup')
+def pair_bams_with_indexes(bam_files, index_files):
+    """
+    Pairs each BAM file with its index file by name, i.e. sample.bam with
+    sample.bam.bai or sample.bai. A single BAM file is paired with the
+    single index file whatever their names.
 
-    idxstat_output = run_samtools_idxstat(bam_file_name, bam_file_prefix)
-    chr_1, chr_y, score = get_mapped_reads(idxstat_output)
-    predicted_sex = get_predicted_sex(score, male_threshold, female_threshold)
-    reported_sex = get_reported_sex(bam_file_name)
-    matched = check_sex_match(reported_sex, predicted_sex)
+    Args:
+        bam_files (list): DNAnexus descriptions of the BAM files.
+        index_files (list): DNAnexus descriptions of the index files.
 
-    # format output to mqc json
-    data = {
-        bam_file_prefix: {
-            "matched": matched,
-            "reported_sex": reported_sex,
-            "predicted_sex": predicted_sex,
-            "score": score,
-            "mapped_chrY": chr_y,
-            "mapped_chr1": chr_1
-        }
-    }
+    Returns:
+        list: (BAM file, index file) description tuples.
 
-    multiqc_config = {
-        "id": "sex_check",
-        "section_name": "Sex Check",
-        "description": "Table comparing reported and predicted sex",
-        "plot_type": "table",
-        "pconfig": {
-            "id": "sex_check_table",
-            "title": "Sex Check Table",
-            "format": "{:.0f}"
-        },
-        "headers": {
-            "matched": {
-                "title": "Matched",
-                "description": "Whether reported sex is same as predicted sex",
-                "cond_formatting_rules": {
-                "pass": [{"s_eq": "True"}],
-                "warn": [{"s_eq": "NA"}],
-                "fail": [{"s_eq": "False"}]
-                }
-            },
-            "reported_sex": {
-                "title": "Reported Sex",
-                "description": "Expected sex reported in sample name",
-                "cond_formatting_rules": {
-                "warn": [{"s_eq": "N"}, {"s_eq": "U"}]
-                }
-            },
-            "predicted_sex": {
-                "title": "Predicted Sex",
-                "description": "Sex inferred from normalised score",
-                "cond_formatting_rules": {
-                "warn": [{"s_eq": "U"}]
-                }
-            },
-            "score": {
-                "title": "Score",
-                "description": "Negative log of mapped_chrY/mapped_chr1",
-                "format": "{:.4f}"
-            },
-            "mapped_chrY": {
-                "title": "Mapped Reads ChrY",
-                "description": "Number of reads mapped to chromosome Y"
-            },
-            "mapped_chr1": {
-                "title": "Mapped Reads Chr1",
-                "description": "Number of reads mapped to chromosome 1"
-            }
-        },
-        "data": data
-    }
+    Raises:
+        ValueError: If no BAM or index files are given, if a BAM file has
+        no index file, if an index file is not used or has the same name as
+        another, or if two BAM files have the same prefix, in which case
+        their outputs would collide.
+    """
+    if not bam_files:
+        raise ValueError("No BAM files given.")
+    if not index_files:
+        raise ValueError("No index files given.")
+
+    if len(bam_files) == 1 and len(index_files) == 1:
+        return [(bam_files[0], index_files[0])]
+
+    indexes = {}
+    for index in index_files:
+        if index["name"] in indexes:
+            raise ValueError(
+                f"More than one index file is named {index['name']}."
+            )
+        indexes[index["name"]] = index
+
+    prefixes = set()
+    pairs = []
+
+    for bam in bam_files:
+        prefix = get_bam_prefix(bam["name"])
+        if prefix in prefixes:
+            raise ValueError(
+                f"More than one BAM file has prefix {prefix}. "
+                "Outputs would overwrite each other."
+            )
+        prefixes.add(prefix)
+
+        index = (
+            indexes.get(bam["name"] + '.bai') or
+            indexes.get(os.path.splitext(bam["name"])[0] + '.bai')
+        )
+        if index is None:
+            raise ValueError(f"No index file found for {bam['name']}.")
+        pairs.append((bam, index))
+
+    unused = set(indexes) - {index["name"] for _, index in pairs}
+    if unused:
+        raise ValueError(
+            f"Index files {', '.join(sorted(unused))} match no BAM file."
+        )
+
+    return pairs
+
+
+def process_single_bam(bam, index, predict_sex, write_idxstats):
+    """
+    Performs sex determination of one BAM file.
+
+    Args:
+        bam (dict): DNAnexus description of the BAM file.
+        index (dict): DNAnexus description of the index of the BAM file.
+        predict_sex (function): Predicts sex from the ratio of chrY to chr1
+        reads, as made by make_sex_predictor.
+        write_idxstats (bool): Whether to write the idxstats to a file, when
+        they are not reused from a previous run.
+
+    Returns:
+        tuple: (prefix of the BAM file,
+                dict of sex check results for the MultiQC table,
+                name of the file containing the idxstat results, or None,
+                or a DNAnexus link to it if reused from a previous run,
+                properties to tag the idxstat file with when uploaded)
+    """
+    bam_file_name = bam["name"]
+    bam_file_prefix = get_bam_prefix(bam_file_name)
+
+    # idxstat files uploaded by this app are tagged with their input files,
+    # so reruns on the same BAM skip downloading it
+    properties = {"input_bam": bam["id"], "index_file": index["id"]}
+    cached_idxstat = find_cached_idxstat(properties)
+
+    if cached_idxstat:
+        idxstat_file = bam_file_prefix + '_idxstat.tsv'
+        print(f"Reusing {cached_idxstat['id']} as {idxstat_file}")
+        dxpy.download_dxfile(
+            cached_idxstat["id"], idxstat_file,
+            project=cached_idxstat["project"]
+        )
+        idxstats = read_idxstat(idxstat_file)
+        # output the cached file itself rather than uploading a copy of it
+        idxstat_output = dxpy.dxlink(
+            cached_idxstat["id"], cached_idxstat["project"]
+        )
+    else:
+        dxpy.download_dxfile(
+            index["id"], index["name"], project=index["project"]
+        )
+
+        # only the header of the BAM is read, so stream it from the platform
+        # rather than downloading the whole file
+        with dxpy.open_dxfile(
+            bam["id"], project=bam["project"], mode="rb",
+            read_buffer_size=BAM_HEADER_BUFFER_SIZE
+        ) as bam_file:
+            idxstats, idxstat_output = load_idxstats(
+                bam_file, index["name"], bam_file_prefix, write_idxstats
+            )
+
+    chr_1, chr_y, ratio = get_mapped_reads(idxstats)
+    result = get_sex_check_result(
+        bam_file_name, chr_1, chr_y, ratio, predict_sex
+    )
+
+    return bam_file_prefix, result, idxstat_output, properties
+
+
+def upload_idxstat(idxstat_output, properties):
+    """
+    Uploads an idxstat file, unless it was reused from a previous run and
+    so is already uploaded.
+
+    Args:
+        idxstat_output (str or dict): name of the file containing the
+        idxstat results, or a DNAnexus link to it if reused.
+        properties (dict): properties to tag the uploaded file with.
+
+    Returns:
+        dict: DNAnexus link to the idxstat file.
+    """
+    if dxpy.is_dxlink(idxstat_output):
+        return idxstat_output
 
-    out_file_name = bam_file_prefix + '_mqc.json'
+    return dxpy.dxlink(
+        dxpy.upload_local_file(idxstat_output, properties=properties)
+    )
 
-    with open(out_file_name, "w", encoding="utf-8") as file:
-        json.dump(multiqc_config, file, indent=2)
 
-    idxstat_output = dxpy.upload_local_file(idxstat_output)
-    sex_check_result = dxpy.upload_local_file(out_file_name)
+@dxpy.entry_point('main')
+def main(input_bam, index_file, male_threshold, female_threshold,
+         upload_idxstats=False):
+    """
+    Main function for the DNAnexus app to perform sex determination
+    based on BAM file data. BAM files are processed concurrently.
 
-    output = {}
-    output["idxstat_output"] = dxpy.dxlink(idxstat_output)
-    output["sex_check_result"] = dxpy.dxlink(sex_check_result)
+    Args:
+        input_bam (list): The IDs of the input BAM files in DNAnexus.
+        index_file (list): The IDs of the index files of the BAM files.
+        male_threshold (float): Value below which sample is considered male.
+        female_threshold (float): Value above which sample is considered female.
+        upload_idxstats (bool): Whether to output the idxstats of each BAM.
+    Returns:
+        dict: Dictionary of output file links in DNAnexus.
+    """
+    # validate and convert thresholds once, before downloading anything
+    predict_sex = make_sex_predictor(male_threshold, female_threshold)
+
+    # describe all input files in one API call rather than one per file
+    descriptions = dxpy.describe(list(input_bam) + list(index_file))
+    bam_files = descriptions[:len(input_bam)]
+    index_files = descriptions[len(input_bam):]
+    pairs = pair_bams_with_indexes(bam_files, index_files)
+
+    # processing a sample is network bound (API calls, index download and
+    # BAM header stream), so run more samples at once than there are cores.
+    # Uploads run in their own pool so they overlap with samples still
+    # being processed
+    workers = min(len(pairs), MAX_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            ThreadPoolExecutor(max_workers=workers) as uploader:
+        futures = [
+            executor.submit(
+                process_single_bam, bam, index, predict_sex, upload_idxstats
+            )
+            for bam, index in pairs
+        ]
+
+        data = {}
+        idxstat_uploads = []
+        for future in futures:
+            prefix, result, idxstat_output, properties = future.result()
+            data[prefix] = result
+            if upload_idxstats:
+                idxstat_uploads.append(uploader.submit(
+                    upload_idxstat, idxstat_output, properties
+                ))
+
+        # format output to mqc json
+        multiqc_config = dict(MULTIQC_CONFIG_TEMPLATE, data=data)
+
+        if len(data) == 1:
+            out_file_name = next(iter(data)) + '_mqc.json'
+        else:
+            out_file_name = 'sex_check_mqc.json'
+
+        with open(out_file_name, "w", encoding="utf-8") as file:
+            # encode in one go rather than json.dump's write per token
+            file.write(json.dumps(multiqc_config, indent=2))
+
+        sex_check_result = uploader.submit(
+            dxpy.upload_local_file, out_file_name
+        )
+
+        output = {}
+        if upload_idxstats:
+            output["idxstat_output"] = [
+                upload.result() for upload in idxstat_uploads
+            ]
+        output["sex_check_result"] = dxpy.dxlink(sex_check_result.result())
 
     return output
 
@@ -1,4 +1,4 @@
-"""sex_check 1.1.0 integration test suite
+"""sex_check 2.0.0 integration test suite
 
 This test validates the functionality of the app as a whole on the DNAnexus 
 platform.
@@ -29,18 +29,19 @@ def make_inputs():
     return {
         "male_threshold": 4.45,
         "female_threshold": 5.40,
-        "input_bam": {
+        "upload_idxstats": True,
+        "input_bam": [{
             "$dnanexus_link": {
                 "project": "project-Ggyb2G84zJ4363x2JqfGgb6J",
                 "id": "file-GgybG1j4VvFvj4zqg20px2gY"
             }
-        },
-        "index_file": {
+        }],
+        "index_file": [{
             "$dnanexus_link": {
                 "project": "project-Ggyb2G84zJ4363x2JqfGgb6J",
                 "id": "file-GgybG1j4VvFp7xFf2F6gzQjP"
             }
-        }
+        }]
     }
 
 
@@ -94,7 +95,8 @@ class TestDXApp(unittest.TestCase):
         self.assertIn("sex_check_result", output)
 
         # Assert values are valid DNAnexus file links
-        self.assertTrue(dxpy.is_dxlink(output["idxstat_output"]))
+        for idxstat_output in output["idxstat_output"]:
+            self.assertTrue(dxpy.is_dxlink(idxstat_output))
         self.assertTrue(dxpy.is_dxlink(output["sex_check_result"]))
 
 
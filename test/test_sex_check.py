@@ -1,36 +1,172 @@
-"""sex_check 1.1.0 test suite
+"""sex_check 2.0.0 test suite
 """
 #!/usr/bin/env python
 
+import io
+import json
+import math
 import os
-import subprocess
 import sys
+import tempfile
 import unittest
 from unittest import mock
 
+import dxpy
+
 sys.path.append(os.path.abspath(
     os.path.join(os.path.dirname(__file__), "..")
 ))
+# write_test_files is found whether the tests are run from test/ or not
+sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 
 from src.sex_check import (
     check_sex_match,
+    get_bam_prefix,
+    get_idxstats,
     get_predicted_sex,
+    get_ratio_thresholds,
     get_reported_sex,
+    get_score,
+    get_sex_check_result,
     get_mapped_reads,
-    run_samtools_idxstat
+    load_idxstats,
+    main,
+    make_sex_predictor,
+    pair_bams_with_indexes,
+    process_single_bam,
+    read_idxstat,
+    validate_thresholds,
+    write_idxstat
 )
+from write_test_files import BAM_REFERENCES, N_NO_COOR, TEST_CASES, make_bai
+
+# test data by file name, e.g. DATA["correct_data.tsv"]
+DATA = dict(TEST_CASES)
+
+
+def idxstat_rows(name):
+    """
+    Read idxstat rows from test data in memory, without a file on disk.
+
+    Args:
+        name (str): File name of the idxstat test data, e.g.
+        "correct_data.tsv".
+
+    Returns:
+        iterator: rows of the idxstat output, as yielded by read_idxstat.
+    """
+    return read_idxstat(io.BytesIO(DATA[name].encode()))
+
+
+def write_file(directory, filename, data):
+    """
+    Write test data to a file, for the functions that need a path.
+
+    Args:
+        directory (str): Directory to write the file in.
+        filename (str): Name of the file to write.
+        data (str or bytes): Content to write to the file.
+
+    Returns:
+        str: The path of the written file.
+    """
+    filepath = os.path.join(directory, filename)
+    if isinstance(data, str):
+        data = data.encode()
+    with open(filepath, "wb") as file:
+        file.write(data)
+
+    return filepath
+
+
+class TestGetIdxstats(unittest.TestCase):
+    """
+    Test cases for the get_idxstats function.
+
+    The BAM header and BAI index are built in memory from BAM_REFERENCES,
+    with read counts matching correct_data.tsv.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        """
+        Set up test data once for the class.
+        """
+        cls.bam_data = DATA["test.bam"]
+        cls.index_data = DATA["test.bam.bai"]
+
+    def get_idxstats(self, bam_data, index_data, complete=True):
+        """Get idxstats of a BAM header and BAI index in memory."""
+        return get_idxstats(
+            io.BytesIO(bam_data), io.BytesIO(index_data), complete
+        )
+
+    def test_idxstats(self):
+        """Test case for read counts of every reference."""
+        idxstats = self.get_idxstats(self.bam_data, self.index_data)
+        self.assertEqual(idxstats, [
+            ("1", 100, 100, 0),
+            ("2", 90, 80, 10),
+            ("X", 80, 70, 10),
+            ("Y", 70, 60, 10),
+            ("Z", 50, 0, 50),
+            ("M", 40, 0, 0),
+            ("*", 0, 0, 5),
+        ])
+
+    def test_incomplete_idxstats(self):
+        """Test case for rows only up to chromosomes 1 and Y."""
+        idxstats = self.get_idxstats(
+            self.bam_data, self.index_data, complete=False
+        )
+        self.assertEqual(
+            [row[0] for row in idxstats], ["1", "2", "X", "Y"]
+        )
 
+    def test_not_a_bam(self):
+        """Test case for a BAM file which is not BGZF compressed."""
+        with self.assertRaises(OSError):
+            self.get_idxstats(self.index_data, self.index_data)
 
-class TestRunSamtoolsIdxstat(unittest.TestCase):
+    def test_not_an_index(self):
+        """Test case for an index file which is not a BAI index."""
+        with self.assertRaises(ValueError):
+            self.get_idxstats(self.bam_data, DATA["correct_data.tsv"].encode())
+
+    def test_index_without_read_counts(self):
+        """Test case for an index with bins but no pseudo-bin read counts."""
+        index_data = make_bai(BAM_REFERENCES, N_NO_COOR, pseudo_bin=False)
+        with self.assertRaisesRegex(ValueError, "Re-index"):
+            self.get_idxstats(self.bam_data, index_data)
+
+    def test_index_without_n_no_coor(self):
+        """Test case for an index ending without unplaced unmapped reads."""
+        index_data = make_bai(BAM_REFERENCES, None)
+        idxstats = self.get_idxstats(self.bam_data, index_data)
+        self.assertEqual(idxstats[-1], ("*", 0, 0, 0))
+        self.assertEqual(len(idxstats), len(BAM_REFERENCES) + 1)
+
+    def test_truncated_index(self):
+        """Test case for an index which ends part way through a reference."""
+        with self.assertRaisesRegex(ValueError, "truncated"):
+            self.get_idxstats(self.bam_data, self.index_data[:50])
+
+    def test_wrong_index(self):
+        """Test case for an index of a BAM with other references."""
+        index_data = make_bai(BAM_REFERENCES[:-1], N_NO_COOR)
+        with self.assertRaises(ValueError):
+            self.get_idxstats(self.bam_data, index_data)
+
+
+class TestWriteIdxstat(unittest.TestCase):
     """
-    Test case for the run_samtools_idxstat function.
+    Test case for the write_idxstat function.
     """
 
     def setUp(self):
         """
         Set up test data.
         """
-        self.bamfile = "test_bamfile.bam"
         self.bamfile_prefix = "test_bamfile"
         self.expected_output_file = self.bamfile_prefix + "_idxstat.tsv"
 
@@ -42,84 +178,192 @@ class TestRunSamtoolsIdxstat(unittest.TestCase):
         if os.path.exists(self.expected_output_file):
             os.remove(self.expected_output_file)
 
-    @mock.patch("src.sex_check.subprocess.run")
-    def test_run_samtools_idxstat_success(self, mock_subprocess_run):
+    def test_write_idxstat(self):
         """
-        Test case for successful execution of samtools idxstat.
+        Test case for writing idxstats in the samtools idxstat format.
         """
-        # Mock subprocess.run to avoid actual execution
-        mock_subprocess_run.return_value.returncode = 0
+        idxstats = idxstat_rows("correct_data.tsv")
+        output_file = write_idxstat(idxstats, self.bamfile_prefix)
+
+        # Assert that the output file name is constructed correctly
+        self.assertEqual(output_file, self.expected_output_file)
+
+        with open(output_file, encoding="utf-8") as file:
+            self.assertEqual(file.read(), DATA["correct_data.tsv"])
 
-        # Call the actual function under test
-        output_file = run_samtools_idxstat(self.bamfile, self.bamfile_prefix)
 
-        # Assert that subprocess.run is called with the correct arguments
-        mock_subprocess_run.assert_called_once_with(
-            ['samtools', 'idxstat', self.bamfile],
-            stdout=mock.ANY, check=True
+class TestReadIdxstat(unittest.TestCase):
+    """
+    Test case for the read_idxstat function.
+    """
+
+    def setUp(self):
+        """
+        Set up a directory for the test files.
+        """
+        self.test_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        """
+        Clean up test data.
+        """
+        self.test_dir.cleanup()
+
+    def test_read_idxstat(self):
+        """Test case for rows being parsed into typed tuples."""
+        filename = write_file(
+            self.test_dir.name, "correct_data.tsv", DATA["correct_data.tsv"]
         )
+        self.assertEqual(list(read_idxstat(filename)), [
+            ("1", 100, 100, 0),
+            ("2", 90, 80, 10),
+            ("X", 80, 70, 10),
+            ("Y", 70, 60, 10),
+            ("Z", 50, 0, 50),
+        ])
+
+    def test_empty_file(self):
+        """Test case for an empty file, which cannot be memory-mapped."""
+        filename = write_file(self.test_dir.name, "empty_idxstat.tsv", "")
+        self.assertEqual(list(read_idxstat(filename)), [])
+
+    def test_file_object(self):
+        """Test case for reading from a file object rather than a path."""
+        data = DATA["without_chry.tsv"].encode()
+        rows = read_idxstat(io.BytesIO(data))
+        self.assertEqual(next(rows), ("1", 100, 100, 0))
+
+
+class TestLoadIdxstats(unittest.TestCase):
+    """
+    Test cases for the load_idxstats function.
 
-        # Assert that the output file name is constructed correctly
-        self.assertEqual(output_file, self.expected_output_file)
+    A stale idxstat TSV is written holding without_chry.tsv, so that
+    whether it was reused or recomputed from the index can be told apart.
+    """
+
+    def setUp(self):
+        """
+        Set up test data, load_idxstats compares the modification times
+        of the files so they are written to a temporary directory.
+        """
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.bamfile = write_file(
+            self.test_dir.name, "test.bam", DATA["test.bam"]
+        )
+        self.index_file = write_file(
+            self.test_dir.name, "test.bam.bai", DATA["test.bam.bai"]
+        )
+        self.bamfile_prefix = os.path.join(self.test_dir.name, "test")
+        self.expected_output_file = write_file(
+            self.test_dir.name, "test_idxstat.tsv", DATA["without_chry.tsv"]
+        )
 
-    @mock.patch("src.sex_check.subprocess.run")
-    def test_failed_run(self, mock_subprocess_run):
+    def tearDown(self):
         """
-        Test case for handling failure of samtools idxstat.
+        Clean up test data.
         """
-        # Mock subprocess.run to simulate a failure
-        mock_subprocess_run.side_effect = subprocess.CalledProcessError(
-            returncode=1, cmd=['samtools', 'idxstat', self.bamfile],
-            stderr="Error: failed to run samtools idxstat"
+        self.test_dir.cleanup()
+
+    def set_output_mtime(self, offset):
+        """Set the output file mtime relative to the index mtime."""
+        mtime = os.stat(self.index_file).st_mtime + offset
+        os.utime(self.expected_output_file, (mtime, mtime))
+
+    def test_reuses_newer_output(self):
+        """Test case for an output file newer than the index."""
+        self.set_output_mtime(10)
+        idxstats, output_file = load_idxstats(
+            self.bamfile, self.index_file, self.bamfile_prefix
         )
+        self.assertEqual(output_file, self.expected_output_file)
+        self.assertEqual(get_mapped_reads(idxstats)[1], 0)
 
-        # Assert that function raises CalledProcessError
-        with self.assertRaises(subprocess.CalledProcessError):
-            run_samtools_idxstat(self.bamfile, self.bamfile_prefix)
+    def test_recomputes_older_output(self):
+        """Test case for an output file older than the index."""
+        self.set_output_mtime(-10)
+        idxstats, output_file = load_idxstats(
+            self.bamfile, self.index_file, self.bamfile_prefix
+        )
+        self.assertEqual(output_file, self.expected_output_file)
+        self.assertEqual(get_mapped_reads(idxstats)[1], 60)
+
+        with open(output_file, encoding="utf-8") as file:
+            self.assertTrue(file.read().startswith(DATA["correct_data.tsv"]))
+
+    def test_without_output(self):
+        """Test case for idxstats not being written to a file."""
+        os.remove(self.expected_output_file)
+        idxstats, output_file = load_idxstats(
+            self.bamfile, self.index_file, self.bamfile_prefix,
+            write_output=False
+        )
+        self.assertIsNone(output_file)
+        self.assertFalse(os.path.exists(self.expected_output_file))
+        self.assertEqual(get_mapped_reads(idxstats)[1], 60)
 
 
 class TestGetMappedReads(unittest.TestCase):
     """
-    Test cases for the get_mapped_reads function.
+    Test cases for the get_mapped_reads function, on the test data read
+    from memory.
 
-    For expected scores:
-    - When both chr1 and chrY are present, the expected score is calculated as
-        -log(chrY/chr1 + epislon).
-    - When either chr1 or chrY is zero, the expected score is set to
-        20.72326583694641, which is -log(1e-9), considering epsilon.
+    For expected ratios:
+    - When both chr1 and chrY are present, the expected ratio is chrY/chr1.
+    - When either chr1 or chrY is zero, the expected ratio is 0.
     """
 
     def test_correct_data(self):
         """Test case for correct data."""
-        filename = os.path.join("test_data", "correct_data.tsv")
-        chr_1, chr_y, score = get_mapped_reads(filename)
+        rows = idxstat_rows("correct_data.tsv")
+        chr_1, chr_y, ratio = get_mapped_reads(rows)
         self.assertEqual(chr_1, 100)
         self.assertEqual(chr_y, 60)
-        self.assertAlmostEqual(score, 0.5108, places=4)
+        self.assertAlmostEqual(ratio, 0.6)
 
     def test_without_chr1(self):
         """Test case for data without chromosome 1."""
-        filename = os.path.join("test_data", "without_chr1.tsv")
-        chr_1, chr_y, score = get_mapped_reads(filename)
+        rows = idxstat_rows("without_chr1.tsv")
+        chr_1, chr_y, ratio = get_mapped_reads(rows)
         self.assertEqual(chr_1, 0)
         self.assertEqual(chr_y, 60)
-        self.assertAlmostEqual(score, 20.7233, places=4)
+        self.assertEqual(ratio, 0)
 
     def test_without_chry(self):
         """Test case for data without chromosome Y."""
-        filename = os.path.join("test_data", "without_chry.tsv")
-        chr_1, chr_y, score = get_mapped_reads(filename)
+        rows = idxstat_rows("without_chry.tsv")
+        chr_1, chr_y, ratio = get_mapped_reads(rows)
         self.assertEqual(chr_1, 100)
         self.assertEqual(chr_y, 0)
-        self.assertAlmostEqual(score, 20.7233, places=4)
+        self.assertEqual(ratio, 0)
 
     def test_with_chr11(self):
         """Test case for data without chr1 but with chr11."""
-        filename = os.path.join("test_data", "with_chr11.tsv")
-        chr_1, chr_y, score = get_mapped_reads(filename)
+        rows = idxstat_rows("with_chr11.tsv")
+        chr_1, chr_y, ratio = get_mapped_reads(rows)
         self.assertEqual(chr_1, 0)
         self.assertEqual(chr_y, 60)
-        self.assertAlmostEqual(score, 20.7233, places=4)
+        self.assertEqual(ratio, 0)
+
+    def test_chr_prefixed_names(self):
+        """Test case for reference names with prefix chr."""
+        idxstats = [
+            ("chr1", 100, 100, 0),
+            ("chr11", 90, 80, 10),
+            ("chrY", 70, 60, 10),
+        ]
+        chr_1, chr_y, ratio = get_mapped_reads(idxstats)
+        self.assertEqual(chr_1, 100)
+        self.assertEqual(chr_y, 60)
+        self.assertAlmostEqual(ratio, 0.6)
+
+    def test_stops_after_chr1_and_chry(self):
+        """Test case for rows after chr1 and chrY not being read."""
+        rows = idxstat_rows("correct_data.tsv")
+        chr_1, chr_y, _ = get_mapped_reads(rows)
+        self.assertEqual((chr_1, chr_y), (100, 60))
+        # Z, the row after Y, is left unread
+        self.assertEqual(next(rows)[0], "Z")
 
 
 class TestGetReportedSex(unittest.TestCase):
@@ -151,38 +395,152 @@ class TestGetReportedSex(unittest.TestCase):
         sample_name = "X12345"
         self.assertEqual(get_reported_sex(sample_name), "N")
 
+    def test_unknown_lower_case_sex(self):
+        """Test for an unknown reported sex given in lower case."""
+        # When the reported sex is lower case and other fields vary
+        sample_name = "X12345-GM1234567-u-12345678"
+        self.assertEqual(get_reported_sex(sample_name), "U")
+
+
+class TestGetScore(unittest.TestCase):
+    """
+    Unit tests for the get_score function.
+
+    When the ratio is zero, the expected score is 20.72326583694641,
+    which is -log(1e-9), considering epsilon.
+    """
+
+    def test_score(self):
+        """Test for the score of a non-zero ratio."""
+        self.assertAlmostEqual(get_score(0.6), 0.5108, places=4)
+
+    def test_zero_ratio(self):
+        """Test for the score of a zero ratio."""
+        self.assertAlmostEqual(get_score(0), 20.7233, places=4)
+
+
+class TestGetRatioThresholds(unittest.TestCase):
+    """
+    Unit tests for the get_ratio_thresholds function.
+    """
+
+    def test_ratio_thresholds(self):
+        """Test for scores converted to ratios, male being the higher."""
+        male_ratio, female_ratio = get_ratio_thresholds(1.0, 2.0)
+        self.assertAlmostEqual(male_ratio, math.exp(-1.0))
+        self.assertAlmostEqual(female_ratio, math.exp(-2.0))
+
+    def test_same_prediction_as_scores(self):
+        """Test for ratios predicting as scores compared to thresholds."""
+        male_ratio, female_ratio = get_ratio_thresholds(1.0, 2.0)
+        for score, expected in ((0.5, "M"), (1.5, "U"), (3.0, "F")):
+            ratio = math.exp(-score)
+            self.assertEqual(ratio >= male_ratio, expected == "M")
+            self.assertEqual(ratio <= female_ratio, expected == "F")
+
+    def test_invalid_thresholds(self):
+        """Test for male threshold not lower than female threshold."""
+        with self.assertRaises(ValueError):
+            get_ratio_thresholds(2.0, 1.0)
+
 
 class TestGetPredictedSex(unittest.TestCase):
     """
     Unit tests for the get_predicted_sex function.
+
+    Score thresholds 1.0 and 2.0 are ratio thresholds of
+    exp(-1) = 0.3679 and exp(-2) = 0.1353.
     """
 
     def test_male_prediction(self):
-        """Test for when the score is below the male threshold."""
-        # When score is lower than male threshold
-        self.assertEqual(get_predicted_sex(0.5, 1.0, 2.0), "M")
+        """Test for when the ratio is above the male threshold."""
+        # When ratio is higher than male threshold
+        self.assertEqual(get_predicted_sex(0.6, 1.0, 2.0), "M")
 
     def test_female_prediction(self):
-        """Test for when the score is above the female threshold."""
-        # When score is higher than female threshold
-        self.assertEqual(get_predicted_sex(3.0, 1.0, 2.0), "F")
+        """Test for when the ratio is below the female threshold."""
+        # When ratio is lower than female threshold
+        self.assertEqual(get_predicted_sex(0.05, 1.0, 2.0), "F")
+
+    def test_no_chry_prediction(self):
+        """Test for when there are no reads on chromosome Y."""
+        self.assertEqual(get_predicted_sex(0, 1.0, 2.0), "F")
 
     def test_unknown_prediction(self):
-        """Test for when the score falls between male and female thresholds."""
-        # When score is between male and female thresholds
-        self.assertEqual(get_predicted_sex(1.5, 1.0, 2.0), "U")
+        """Test for when the ratio falls between male and female thresholds."""
+        # When ratio is between male and female thresholds
+        self.assertEqual(get_predicted_sex(0.3, 1.0, 2.0), "U")
 
     def test_equal_thresholds(self):
         """Test for when male and female thresholds are equal."""
         # When male and female thresholds are equal
         with self.assertRaises(ValueError):
-            get_predicted_sex(1.5, 2.0, 2.0)
+            get_predicted_sex(0.3, 1.0, 1.0)
+
+    def test_underflowing_thresholds(self):
+        """Test for valid thresholds whose ratios underflow to zero."""
+        self.assertEqual(get_predicted_sex(0.6, 800, 900), "M")
+
+    def test_invalid_thresholds(self):
+        """Test for when male threshold is higher than female threshold."""
+        # When male threshold is higher than female threshold
+        with self.assertRaises(ValueError):
+            get_predicted_sex(0.3, 2.0, 1.0)
+
+
+class TestMakeSexPredictor(unittest.TestCase):
+    """
+    Unit tests for the make_sex_predictor function.
+
+    Score thresholds 1.0 and 2.0 are ratio thresholds of
+    exp(-1) = 0.3679 and exp(-2) = 0.1353.
+    """
+
+    def test_predictions(self):
+        """Test for male, female and unknown predictions of one predictor."""
+        predict_sex = make_sex_predictor(1.0, 2.0)
+        self.assertEqual(predict_sex(0.6), "M")
+        self.assertEqual(predict_sex(0.05), "F")
+        self.assertEqual(predict_sex(0.3), "U")
+
+    def test_matches_score_thresholds(self):
+        """Test for predictions agreeing with scores against thresholds."""
+        predict_sex = make_sex_predictor(1.0, 2.0)
+        self.assertEqual(predict_sex(math.exp(-0.5)), "M")
+        self.assertEqual(predict_sex(math.exp(-2.5)), "F")
+        self.assertEqual(predict_sex(math.exp(-1.5)), "U")
+
+    def test_underflowing_thresholds(self):
+        """Test for valid thresholds whose ratios underflow to zero."""
+        predict_sex = make_sex_predictor(800, 900)
+        self.assertEqual(predict_sex(0.6), "M")
+
+    def test_equal_thresholds(self):
+        """Test for when male and female thresholds are equal."""
+        with self.assertRaises(ValueError):
+            make_sex_predictor(1.0, 1.0)
+
+    def test_invalid_thresholds(self):
+        """Test for when male threshold is higher than female threshold."""
+        with self.assertRaises(ValueError):
+            make_sex_predictor(2.0, 1.0)
+
+
+class TestValidateThresholds(unittest.TestCase):
+    """
+    Unit tests for the validate_thresholds function.
+    """
+
+    def test_valid_thresholds(self):
+        """Test for male threshold lower than female threshold."""
+        validate_thresholds(1.0, 2.0)
 
     def test_invalid_thresholds(self):
-        """Test for when male threshold is greater than female threshold."""
-        # When male threshold is greater than female threshold
+        """Test for male threshold not lower than female threshold."""
+        with self.assertRaises(ValueError):
+            validate_thresholds(2.0, 2.0)
         with self.assertRaises(ValueError):
-            get_predicted_sex(1.5, 2.0, 1.0)
+            validate_thresholds(2.0, 1.0)
 
 
 class TestCheckSexMatch(unittest.TestCase):
@@ -194,6 +552,11 @@ class TestCheckSexMatch(unittest.TestCase):
         self.assertEqual(check_sex_match("N", "M"), "NA")
         self.assertEqual(check_sex_match("U", "F"), "NA")
 
+    def test_check_sex_match_undetermined_prediction(self):
+        """Test for a reported sex when the predicted sex is unknown."""
+        self.assertEqual(check_sex_match("M", "U"), "False")
+        self.assertEqual(check_sex_match("F", "U"), "False")
+
     def test_matching_sex(self):
         """Test case for when the reported sex matches the predicted sex."""
         self.assertEqual(check_sex_match("M", "M"), "True")
@@ -205,5 +568,325 @@ class TestCheckSexMatch(unittest.TestCase):
         self.assertEqual(check_sex_match("F", "M"), "False")   
 
 
+class TestGetSexCheckResult(unittest.TestCase):
+    """
+    Unit tests for the get_sex_check_result function.
+    """
+
+    def setUp(self):
+        """
+        Set up test data.
+        """
+        self.predict_sex = make_sex_predictor(1.0, 2.0)
+
+    def test_matching_result(self):
+        """Test for a male sample reported as male."""
+        result = get_sex_check_result(
+            "X12345-GM1234567-23xxxx4-1234-M-12345678", 100, 60, 0.6,
+            self.predict_sex
+        )
+        self.assertEqual(result, {
+            "matched": "True",
+            "reported_sex": "M",
+            "predicted_sex": "M",
+            "score": get_score(0.6),
+            "mapped_chrY": 60,
+            "mapped_chr1": 100
+        })
+
+    def test_mismatching_result(self):
+        """Test for a sample without chrY reads reported as male."""
+        result = get_sex_check_result(
+            "X12345-GM1234567-23xxxx4-1234-M-12345678", 100, 0, 0,
+            self.predict_sex
+        )
+        self.assertEqual(result["predicted_sex"], "F")
+        self.assertEqual(result["matched"], "False")
+
+
+class TestGetBamPrefix(unittest.TestCase):
+    """
+    Unit tests for the get_bam_prefix function.
+    """
+
+    def test_bam_prefix(self):
+        """Test for the .bam extension being removed."""
+        self.assertEqual(get_bam_prefix("sample.bam"), "sample")
+
+    def test_markdup_prefix(self):
+        """Test for the _markdup suffix being removed."""
+        self.assertEqual(get_bam_prefix("sample_markdup.bam"), "sample")
+
+    def test_prefix_ending_in_markdup_letters(self):
+        """Test for only the whole _markdup suffix being removed."""
+        self.assertEqual(get_bam_prefix("sample_dup.bam"), "sample_dup")
+        self.assertEqual(get_bam_prefix("sample_a.bam"), "sample_a")
+
+
+class TestPairBamsWithIndexes(unittest.TestCase):
+    """
+    Unit tests for the pair_bams_with_indexes function.
+    """
+
+    @staticmethod
+    def files(*names):
+        """Make DNAnexus file descriptions with the given names."""
+        return [{"name": name} for name in names]
+
+    def test_pairs_by_name(self):
+        """Test for BAMs being paired with <bam>.bai and <prefix>.bai."""
+        bams = self.files("a.bam", "b.bam")
+        indexes = self.files("b.bai", "a.bam.bai")
+        pairs = pair_bams_with_indexes(bams, indexes)
+        self.assertEqual(
+            [(bam["name"], index["name"]) for bam, index in pairs],
+            [("a.bam", "a.bam.bai"), ("b.bam", "b.bai")]
+        )
+
+    def test_single_pair(self):
+        """Test for a single BAM being paired whatever the index name."""
+        bams = self.files("a.bam")
+        indexes = self.files("other.bai")
+        pairs = pair_bams_with_indexes(bams, indexes)
+        self.assertEqual(pairs, [(bams[0], indexes[0])])
+
+    def test_missing_index(self):
+        """Test for a BAM without index."""
+        bams = self.files("a.bam", "b.bam")
+        indexes = self.files("a.bam.bai", "c.bam.bai")
+        with self.assertRaises(ValueError):
+            pair_bams_with_indexes(bams, indexes)
+
+    def test_duplicate_prefix(self):
+        """Test for two BAMs with the same prefix."""
+        bams = self.files("a.bam", "a_markdup.bam")
+        indexes = self.files("a.bam.bai", "a_markdup.bam.bai")
+        with self.assertRaises(ValueError):
+            pair_bams_with_indexes(bams, indexes)
+
+    def test_no_bams(self):
+        """Test for no BAM files being given."""
+        with self.assertRaisesRegex(ValueError, "No BAM files"):
+            pair_bams_with_indexes([], self.files("a.bam.bai"))
+
+    def test_no_indexes(self):
+        """Test for no index files being given."""
+        with self.assertRaisesRegex(ValueError, "No index files"):
+            pair_bams_with_indexes(self.files("a.bam"), [])
+
+    def test_extra_index(self):
+        """Test for an index file matching no BAM."""
+        bams = self.files("a.bam", "b.bam")
+        indexes = self.files("a.bam.bai", "b.bam.bai", "c.bam.bai")
+        with self.assertRaisesRegex(ValueError, "c.bam.bai"):
+            pair_bams_with_indexes(bams, indexes)
+
+    def test_duplicate_index_name(self):
+        """Test for two index files with the same name."""
+        bams = self.files("a.bam", "b.bam")
+        indexes = self.files("a.bam.bai", "b.bam.bai", "a.bam.bai")
+        with self.assertRaisesRegex(ValueError, "More than one index"):
+            pair_bams_with_indexes(bams, indexes)
+
+
+class TestProcessSingleBam(unittest.TestCase):
+    """
+    Unit tests for the process_single_bam function, with the DNAnexus
+    API calls mocked.
+    """
+
+    def setUp(self):
+        """
+        Set up test data, files are downloaded to a temporary directory.
+        """
+        self.cwd = os.getcwd()
+        self.test_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.test_dir.name)
+        self.bam = {"id": "file-bam", "project": "project-1",
+                    "name": "sample.bam"}
+        self.index = {"id": "file-bai", "project": "project-1",
+                      "name": "sample.bam.bai"}
+
+    def tearDown(self):
+        """
+        Clean up test data.
+        """
+        os.chdir(self.cwd)
+        self.test_dir.cleanup()
+
+    @mock.patch("src.sex_check.dxpy.open_dxfile")
+    @mock.patch("src.sex_check.dxpy.download_dxfile")
+    @mock.patch("src.sex_check.find_cached_idxstat")
+    def test_reuses_cached_idxstat(self, mock_find, mock_download,
+                                   mock_open):
+        """Test for a cached idxstat file being linked, not re-uploaded."""
+        mock_find.return_value = {"id": "file-cached", "project": "project-1"}
+        mock_download.side_effect = lambda file_id, filename, project: \
+            write_file(".", filename, DATA["correct_data.tsv"])
+
+        prefix, result, idxstat_output, _ = process_single_bam(
+            self.bam, self.index, make_sex_predictor(1.0, 2.0), True
+        )
+
+        self.assertEqual(prefix, "sample")
+        self.assertEqual(result["mapped_chrY"], 60)
+        self.assertEqual(
+            idxstat_output,
+            {"$dnanexus_link": {"id": "file-cached", "project": "project-1"}}
+        )
+        # only the cached idxstat file is downloaded
+        mock_download.assert_called_once_with(
+            "file-cached", "sample_idxstat.tsv", project="project-1"
+        )
+        mock_open.assert_not_called()
+
+
+
+class TestMain(unittest.TestCase):
+    """
+    Unit tests for the main function, with the DNAnexus API calls mocked.
+
+    Each BAM file is named <sample>.bam with index <sample>.bam.bai, and
+    has the read counts of correct_data.tsv, i.e. is predicted male.
+    """
+
+    def setUp(self):
+        """
+        Set up test data and mocks, files are written to a temporary
+        directory.
+        """
+        self.cwd = os.getcwd()
+        self.test_dir = tempfile.TemporaryDirectory()
+        os.chdir(self.test_dir.name)
+
+        # idxstat files uploaded by a previous run, by input BAM ID
+        self.cached = {}
+
+        self.mock_describe = self.patch("src.sex_check.dxpy.describe")
+        self.mock_describe.side_effect = lambda ids: [
+            self.describe(file_id) for file_id in ids
+        ]
+        self.mock_download = self.patch("src.sex_check.dxpy.download_dxfile")
+        self.mock_download.side_effect = self.download
+        self.mock_open = self.patch("src.sex_check.dxpy.open_dxfile")
+        self.mock_open.side_effect = \
+            lambda *args, **kwargs: io.BytesIO(DATA["test.bam"])
+        self.mock_upload = self.patch("src.sex_check.dxpy.upload_local_file")
+        self.mock_upload.side_effect = \
+            lambda filename, **kwargs: f"file-{filename}"
+        self.mock_find = self.patch("src.sex_check.find_cached_idxstat")
+        self.mock_find.side_effect = \
+            lambda properties: self.cached.get(properties["input_bam"])
+
+    def tearDown(self):
+        """
+        Clean up test data.
+        """
+        os.chdir(self.cwd)
+        self.test_dir.cleanup()
+
+    def patch(self, target):
+        """Patch target for the duration of the test."""
+        patcher = mock.patch(target)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    @staticmethod
+    def describe(file_id):
+        """Describe a file-<name> ID as a file named <name>."""
+        return {"id": file_id, "project": "project-1", "name": file_id[5:]}
+
+    @staticmethod
+    def download(file_id, filename, project):
+        """Write the index or cached idxstat file being downloaded."""
+        if filename.endswith(".bai"):
+            write_file(".", filename, DATA["test.bam.bai"])
+        else:
+            write_file(".", filename, DATA["correct_data.tsv"])
+
+    @staticmethod
+    def run_main(samples, upload_idxstats):
+        """Run main on the BAM files of the given samples."""
+        return main(
+            [f"file-{sample}.bam" for sample in samples],
+            [f"file-{sample}.bam.bai" for sample in samples],
+            1.0, 2.0, upload_idxstats
+        )
+
+    def test_single_sample(self):
+        """Test for the outputs of a single BAM with idxstats uploaded."""
+        output = self.run_main(["a"], True)
+
+        self.assertEqual(output, {
+            "idxstat_output": [dxpy.dxlink("file-a_idxstat.tsv")],
+            "sex_check_result": dxpy.dxlink("file-a_mqc.json")
+        })
+        self.assertCountEqual(self.mock_upload.call_args_list, [
+            mock.call("a_idxstat.tsv", properties={
+                "input_bam": "file-a.bam", "index_file": "file-a.bam.bai"
+            }),
+            mock.call("a_mqc.json")
+        ])
+        with open("a_mqc.json", encoding="utf-8") as file:
+            data = json.load(file)["data"]
+        self.assertEqual(data["a"]["predicted_sex"], "M")
+        self.assertEqual(data["a"]["mapped_chrY"], 60)
+
+    def test_multiple_samples(self):
+        """Test for the outputs of several BAMs, in input order."""
+        output = self.run_main(["b", "a"], True)
+
+        self.assertEqual(output, {
+            "idxstat_output": [
+                dxpy.dxlink("file-b_idxstat.tsv"),
+                dxpy.dxlink("file-a_idxstat.tsv")
+            ],
+            "sex_check_result": dxpy.dxlink("file-sex_check_mqc.json")
+        })
+        with open("sex_check_mqc.json", encoding="utf-8") as file:
+            self.assertEqual(set(json.load(file)["data"]), {"a", "b"})
+
+    def test_cached_idxstat(self):
+        """Test for a cached idxstat file being output, not re-uploaded."""
+        self.cached["file-a.bam"] = {
+            "id": "file-cached", "project": "project-1"
+        }
+        output = self.run_main(["a", "b"], True)
+
+        self.assertEqual(output["idxstat_output"], [
+            dxpy.dxlink("file-cached", "project-1"),
+            dxpy.dxlink("file-b_idxstat.tsv")
+        ])
+        self.assertCountEqual(self.mock_upload.call_args_list, [
+            mock.call("b_idxstat.tsv", properties={
+                "input_bam": "file-b.bam", "index_file": "file-b.bam.bai"
+            }),
+            mock.call("sex_check_mqc.json")
+        ])
+        # the BAM header is only streamed for the sample without cache
+        self.mock_open.assert_called_once()
+
+    def test_without_idxstat_upload(self):
+        """Test for only the MultiQC JSON being output without the flag."""
+        output = self.run_main(["a"], False)
+
+        self.assertEqual(output, {
+            "sex_check_result": dxpy.dxlink("file-a_mqc.json")
+        })
+        self.mock_upload.assert_called_once_with("a_mqc.json")
+        # idxstats are not written when they are not uploaded
+        self.assertFalse(os.path.exists("a_idxstat.tsv"))
+
+    def test_cached_idxstat_without_upload(self):
+        """Test for a cached idxstat file not being output without the flag."""
+        self.cached["file-a.bam"] = {
+            "id": "file-cached", "project": "project-1"
+        }
+        output = self.run_main(["a", "b"], False)
+
+        self.assertNotIn("idxstat_output", output)
+        self.mock_upload.assert_called_once_with("sex_check_mqc.json")
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,14 +1,17 @@
-#!/usr/bin/env python
 """
-Script to generate test data files for testing get_mapped_reads function.
-Each file represents different scenarios:
+Test data for testing the get_mapped_reads function, used by the unit
+tests directly from memory. Each case represents different scenarios:
 - Complete data
 - Without chromosome 1
 - Without chromosome Y
 - Without chromosome 1 but with chr11
+
+Also builds a minimal BAM header and BAI index matching the complete
+data, for testing get_idxstats.
 """
 
-import os
+import gzip
+import struct
 
 # Test data for correct idxstat output
 CORRECT_DATA = """1\t100\t100\t0
@@ -43,30 +46,83 @@ Z\t50\t0\t50
 """
 
 
-def write_test_data(directory, filename, data):
+# References (name, length, mapped, unmapped) of the test BAM and BAI,
+# matching CORRECT_DATA; Z has only unmapped reads and M has no reads
+BAM_REFERENCES = [
+    ("1", 100, 100, 0),
+    ("2", 90, 80, 10),
+    ("X", 80, 70, 10),
+    ("Y", 70, 60, 10),
+    ("Z", 50, 0, 50),
+    ("M", 40, 0, 0),
+]
+
+# Number of unplaced unmapped reads in the test BAI
+N_NO_COOR = 5
+
+
+def make_bam_header(references):
+    """
+    Build a BGZF compressed BAM header holding the given references.
+
+    Args:
+        references (list): (name, length, ...) tuples of the references.
+
+    Returns:
+        bytes: The compressed BAM header.
+    """
+    text = b"@HD\tVN:1.6\tSO:coordinate\n"
+    header = b"BAM\1" + struct.pack("<i", len(text)) + text
+    header += struct.pack("<i", len(references))
+    for name, length, *_ in references:
+        name = name.encode() + b"\0"
+        header += struct.pack("<i", len(name)) + name
+        header += struct.pack("<i", length)
+
+    return gzip.compress(header, mtime=0)
+
+
+def make_bai(references, n_no_coor, pseudo_bin=True):
     """
-    Write test data to a file.
+    Build a BAI index holding the read counts of the given references.
+    References with reads get one bin with one chunk, the pseudo-bin with
+    their read counts and one linear index interval.
 
     Args:
-        directory (str): Directory to write the file.
-        filename (str): Name of the file to write.
-        data (str): Content to write to the file.
+        references (list): (name, length, mapped, unmapped) tuples.
+        n_no_coor (int): Number of unplaced unmapped reads, left out of the
+        index if None.
+        pseudo_bin (bool): Whether references with reads have a pseudo-bin,
+        as indexes from samtools do.
+
+    Returns:
+        bytes: The BAI index.
     """
-    os.makedirs(directory, exist_ok=True)
-    filepath = os.path.join(directory, filename)
-    with open(filepath, "w", encoding="utf-8") as file:
-        file.write(data)
+    index = b"BAI\1" + struct.pack("<i", len(references))
+    for _, _, mapped, unmapped in references:
+        if not mapped and not unmapped:
+            index += struct.pack("<ii", 0, 0)
+            continue
+        index += struct.pack("<i", 2 if pseudo_bin else 1)
+        index += struct.pack("<IiQQ", 4681, 1, 0, 1000)
+        if pseudo_bin:
+            index += struct.pack(
+                "<IiQQQQ", 37450, 2, 0, 1000, mapped, unmapped
+            )
+        index += struct.pack("<iQ", 1, 0)
 
+    if n_no_coor is None:
+        return index
 
+    return index + struct.pack("<Q", n_no_coor)
+
+
+# Test data by the name of the file each case stands in for
 TEST_CASES = [
     ("correct_data.tsv", CORRECT_DATA),
     ("without_chr1.tsv", WITHOUT_CHR1_DATA),
     ("without_chry.tsv", WITHOUT_CHRY_DATA),
     ("with_chr11.tsv", WITH_CHR11_DATA),
+    ("test.bam", make_bam_header(BAM_REFERENCES)),
+    ("test.bam.bai", make_bai(BAM_REFERENCES, N_NO_COOR)),
 ]
-
-TEST_DATA_DIR = "test_data"
-
-if __name__ == "__main__":
-    for filename, data in TEST_CASES:
-        write_test_data(TEST_DATA_DIR, filename, data)